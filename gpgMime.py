@@ -48,31 +48,149 @@ Documented by: Jay S. Liu
 """
 import os, copy, email
 import tempfile, cStringIO
+from email.message import Message as _Message
 from email.mime.application import MIMEApplication as _MIMEApplication
+from email.mime.base import MIMEBase as _MIMEBase
 from email.mime.multipart import MIMEMultipart as _MIMEMultipart
 from email.encoders import encode_7or8bit as _encode_7or8bit
-from email.generator import Generator
+from email.generator import Generator, _make_boundary, fcre as _fcre
+from email.utils import make_msgid as _make_msgid
 
 __version__ = '0.1.4'
 
-def _flatten(message):
-    fp = cStringIO.StringIO()
-    g = Generator(fp, mangle_from_=False)
+# default in-memory size (bytes) of a buffer before it spills to a temporary file
+SPOOL_SIZE = 16 * 1024 * 1024
+
+class _SpoolWriter(object):
+    r"""Write to the spooled temporary file ``fp`` in small pieces,
+    with every '\n' replaced by '\r\n' if ``crlf``
+
+    the generator writes a whole payload at once; handed over in one
+    piece, it would be held in memory before ``fp`` spills to disk
+    """
+    _piece = 64 * 1024
+
+    def __init__(self, fp, crlf=False):
+        self._fp = fp
+        self._crlf = crlf
+
+    def write(self, s):
+        for i in range(0, len(s), self._piece):
+            piece = s[i:i+self._piece]
+            if self._crlf:
+                piece = piece.replace('\n', '\r\n')
+            self._fp.write(piece)
+
+class _StreamGenerator(Generator):
+    r"""``Generator`` writing headers and parts straight to its file
+
+    the stock Generator renders every body and subpart into a StringIO
+    first, in order to pick a boundary absent from the text; here a
+    missing boundary is drawn at random before the headers are written,
+    so the output is the same as Generator's, without the copies
+    """
+    def _write(self, msg):
+        if msg.get_content_maintype() == 'multipart' and not msg.get_boundary():
+            msg.set_boundary(_make_boundary())
+        meth = getattr(msg, '_write_headers', None)
+        if meth is None:
+            self._write_headers(msg)
+        else:
+            meth(self)
+        self._dispatch(msg)
+
+    def _handle_multipart(self, msg):
+        subparts = msg.get_payload()
+        if subparts is None:
+            subparts = []
+        elif isinstance(subparts, basestring):
+            self._fp.write(subparts)
+            return
+        elif not isinstance(subparts, list):
+            subparts = [subparts]
+        boundary = msg.get_boundary()
+        if msg.preamble is not None:
+            if self._mangle_from_:
+                print >> self._fp, _fcre.sub('>From ', msg.preamble)
+            else:
+                print >> self._fp, msg.preamble
+        print >> self._fp, '--' + boundary
+        for i, part in enumerate(subparts):
+            if i:
+                print >> self._fp, '\n--' + boundary
+            self.clone(self._fp).flatten(part, unixfrom=False)
+        self._fp.write('\n--' + boundary + '--\n')
+        if msg.epilogue is not None:
+            if self._mangle_from_:
+                self._fp.write(_fcre.sub('>From ', msg.epilogue))
+            else:
+                self._fp.write(msg.epilogue)
+
+def _spool(message, crlf=False, spool_size=SPOOL_SIZE):
+    r"""Flatten ``message`` into a spooled temporary file, rewound for reading
+
+    the file stays in memory up to ``spool_size`` bytes, and spills to disk
+    beyond that; with ``crlf`` lines are ended by '\r\n' (RFC 3156)
+    """
+    fp = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    g = _StreamGenerator(_SpoolWriter(fp, crlf), mangle_from_=False)
     g.flatten(message)
-    return fp.getvalue()
+    fp.seek(0)
+    return fp
 
+def _encode_7bit(msg):
+    r"""Set the Content-Transfer-Encoding of ASCII armored gpg output
+
+    encode_7or8bit would check the payload by decoding it into unicode,
+    four times its size in memory
+    """
+    msg['Content-Transfer-Encoding'] = '7bit'
+
+def flatten(message, fp, unixfrom=False):
+    r"""Write ``message`` to file ``fp``, without building it as a string
+    """
+    g = _StreamGenerator(fp, mangle_from_=False)
+    g.flatten(message, unixfrom=unixfrom)
 
-def sign(message, gpg, **kwargs):
+
+class PartialMessage(_Message):
+    r"""``Message`` that keeps the body of a message/partial part as a string
+
+    the email parser treats the body of any message/* part as a nested
+    message, and flattening it again re-formats the fragment; this breaks
+    both the signature of the fragment and the reassembly.  Reporting
+    message/partial as a non-message type to the parser keeps it intact.
+    """
+    def get_content_maintype(self):
+        if self.get_content_type() == 'message/partial':
+            return 'application'
+        return _Message.get_content_maintype(self)
+
+def message_from_string(s):
+    r"""Parse string ``s`` into a ``PartialMessage``
+    """
+    return email.message_from_string(s, _class=PartialMessage)
+
+def message_from_file(fp):
+    r"""Parse file ``fp`` into a ``PartialMessage``
+    """
+    return email.message_from_file(fp, _class=PartialMessage)
+
+
+def sign(message, gpg, spool_size=SPOOL_SIZE, **kwargs):
     r"""Sign a ``Message``, returning the signed version.
 
-    using gpg.sign()
+    using gpg.sign_file()
     others, mostly, taken from W. T. King
     """
     # should use replace, otherwise it does NOT work
     #   READ ---- page 5 of RFC 3156
-    flattenedMsg = _flatten(message).replace('\n', '\r\n')
+    flattenedMsg = _spool(message, crlf=True, spool_size=spool_size)
     assert kwargs
-    signature = str( gpg.sign(flattenedMsg, detach=True, **kwargs) )
+    try:
+        signature = str( gpg.sign_file(flattenedMsg, detach=True, **kwargs) )
+    finally:
+        flattenedMsg.close()
     assert signature
     sig = _MIMEApplication(
         _data=signature,
@@ -88,20 +206,29 @@ def sign(message, gpg, **kwargs):
     msg['Content-Disposition'] = 'inline'
     return msg
 
-def encrypt(message, recipients, gpg, **kwargs):
+def encrypt(message, recipients, gpg, spool_size=SPOOL_SIZE, **kwargs):
     r"""Encrypt a ``Message``, returning the encrypted version.
 
-    using gpg.encrypt()
+    using gpg.encrypt_file(), with gpg writing into a temporary file
     others, mostly, taken from W. T. King    
     """
-    flattenedMsg = _flatten(message)
-    eResult = gpg.encrypt(flattenedMsg, recipients, **kwargs)
-    assert eResult.ok == True, (recipients, kwargs)
-    encrypted = eResult.data
+    flattenedMsg = _spool(message, spool_size=spool_size)
+    fd, encFile = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        eResult = gpg.encrypt_file(flattenedMsg, recipients,
+                                   output=encFile, **kwargs)
+        assert eResult.ok == True, (recipients, kwargs)
+        fp = open(encFile, 'rb')
+        encrypted = fp.read()
+        fp.close()
+    finally:
+        flattenedMsg.close()
+        os.remove(encFile)
     enc = _MIMEApplication(
         _data=encrypted,
         _subtype='octet-stream; name="encrypted.asc"',
-        _encoder=_encode_7or8bit)
+        _encoder=_encode_7bit)
     enc['Content-Description'] = 'OpenPGP encrypted message'
     enc.set_charset('us-ascii')
     control = _MIMEApplication(
@@ -118,11 +245,11 @@ def encrypt(message, recipients, gpg, **kwargs):
     msg['Content-Disposition'] = 'inline'
     return msg
 
-def sign_and_encrypt(message, recipients, gpg, **kwargs):
+def sign_and_encrypt(message, recipients, gpg, spool_size=SPOOL_SIZE, **kwargs):
     r"""Sign and encrypt a ``Message``, returning the encrypted version.
     """
-    signd = sign(message, gpg, **kwargs)
-    msg = encrypt(signd, recipients, gpg)
+    signd = sign(message, gpg, spool_size=spool_size, **kwargs)
+    msg = encrypt(signd, recipients, gpg, spool_size=spool_size)
     return msg
 
 
@@ -199,7 +326,7 @@ def decrypt(message, gpg, **kwargs):
         encrypted = encrypted.encode('us-ascii')
     result = gpg.decrypt(encrypted, **kwargs)
     assert result.ok == True, result
-    return email.message_from_string(result.data)
+    return message_from_string(result.data)
 
 def verify(message, gpg, **kwargs):
     r"""Verify a signature on ``message``, possibly decrypting first
@@ -217,7 +344,7 @@ def verify(message, gpg, **kwargs):
             encrypted = encrypted.encode('us-ascii')
         result = gpg.decrypt(encrypted, **kwargs)   # result.data in string
         assert result.ok == True, result
-        message = email.message_from_string(result.data) # string --> MIME message
+        message = message_from_string(result.data) # string --> MIME message
     body, signature = _get_signed_parts(message)
     sig_data = signature.get_payload(decode=True)
     if not isinstance(sig_data, bytes):
@@ -229,11 +356,79 @@ def verify(message, gpg, **kwargs):
     #
     #
     sig_stream = cStringIO.StringIO(sig_data)  # 1. convert signature to a stream
-    fBody = _flatten(body).replace('\n', '\r\n')
     tmpFile = tempfile.NamedTemporaryFile()    # 2. save (replaced)body to a tempfile
-    tmpFile.write(fBody)
+    g = _StreamGenerator(_SpoolWriter(tmpFile, crlf=True), mangle_from_=False)
+    g.flatten(body)
     tmpFile.flush()
     verified = gpg.verify_file(sig_stream, tmpFile.name)
     assert verified.valid == True, verified
     return (copy.deepcopy(body), verified)
 
+
+def partial(message, size, id=None, spool_size=SPOOL_SIZE):
+    r"""Split a ``Message`` into RFC 2046 message/partial fragments
+
+    the flattened ``message`` is cut on line boundaries into fragments of
+    at most ``size`` bytes (a single longer line makes its own fragment);
+    returns the list of message/partial messages, numbered from 1
+    """
+    assert size > 0, size
+    if not id:
+        id = _make_msgid()
+    chunks = []
+    chunk = []
+    chunkSize = 0
+    flattenedMsg = _spool(message, spool_size=spool_size)
+    for line in flattenedMsg:
+        if chunk and chunkSize + len(line) > size:
+            chunks.append(''.join(chunk))
+            chunk = []
+            chunkSize = 0
+        chunk.append(line)
+        chunkSize += len(line)
+    flattenedMsg.close()
+    if chunk or not chunks:
+        chunks.append(''.join(chunk))
+    fragments = []
+    for number, chunk in enumerate(chunks, 1):
+        fragment = _MIMEBase(
+            'message', 'partial',
+            id=id, number=str(number), total=str(len(chunks)))
+        fragment.set_payload(chunk)
+        fragments.append(fragment)
+    return fragments
+
+def reassemble(fragments):
+    r"""Reassemble a complete set of message/partial ``fragments``
+
+    the fragments must share the same id and may be given in any order;
+    repeated copies of a fragment are accepted if they are identical;
+    returns the original message
+    """
+    assert fragments
+    id = total = None
+    chunks = {}
+    for fragment in fragments:
+        ct = fragment.get_content_type()
+        assert ct == 'message/partial', ct
+        if id is None:
+            id = fragment.get_param('id')
+        elif fragment.get_param('id') != id:
+            raise ValueError('fragments of different messages')
+        number = int(fragment.get_param('number'))
+        chunk = fragment.get_payload()
+        if number in chunks and chunks[number] != chunk:
+            raise ValueError('different fragments number {}'.format(number))
+        chunks[number] = chunk
+        if fragment.get_param('total'):
+            _total = int(fragment.get_param('total'))
+            if total and _total != total:
+                raise ValueError('different total numbers of fragments '
+                                 '{} and {}'.format(total, _total))
+            total = _total
+    if not total:
+        raise ValueError('missing total number of fragments')
+    missing = [n for n in range(1, total+1) if n not in chunks]
+    if missing:
+        raise ValueError('missing fragments {}'.format(missing))
+    return message_from_string(''.join(chunks[n] for n in range(1, total+1)))
@@ -12,6 +12,12 @@
         5. Sencrypt -- Symmetric encryption using passphrase
                         (for fun and personal usage)
         6. sign-Sencrypt -- (for fun and personal usage)
+
+    large messages can be split (--split) into message/partial fragments
+    (RFC 2046), each of them signed/encrypted in parallel and sent alone;
+    messages flattened for gnupg spill to disk beyond --spool-size bytes and
+    --output streams the result; the Base64 attachments, the ciphertext and
+    the final message sent through SMTP are still held in memory
     
     By: Jay S. Liu
         jay.s.liu@gmail.com
@@ -19,18 +25,19 @@
         Version 0.1.4
 """
 
-import os, sys, smtplib
+import os, sys, smtplib, resource, base64
 import gnupg
 import mimetypes
 import os.path
 import zipfile, tempfile
-from email import encoders
 from email.mime.text import MIMEText as _MIMEText
-from email.mime.audio import MIMEAudio
 from email.mime.base import MIMEBase
-from email.mime.image import MIMEImage
 from email.mime.multipart import MIMEMultipart
 from email.parser import HeaderParser
+from email.utils import make_msgid
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import gpgMime
 
 def nonAsciiString(str):
     r"""A simple but not reliable check on encoding type of input string
@@ -64,6 +71,26 @@ def attach_root(header, root_part):
         root_part[k] = v
     return root_part
 
+def base64_from_file(filename, chunk=57*4096):
+    r"""Read ``filename`` piecewise and return it in Base64, the same as
+    email.encoders.encode_base64 does, without the whole file in memory
+
+    ``chunk`` is a multiple of 57 bytes, the input of one Base64 line
+    """
+    pieces = []
+    fp = open(filename, 'rb')
+    data = fp.read(chunk)
+    last = ''
+    while data:
+        pieces.append(base64.encodestring(data))
+        last = data
+        data = fp.read(chunk)
+    fp.close()
+    # no newline after the last line, unless the file ends with one
+    if pieces and last[-1] != '\n':
+        pieces[-1] = pieces[-1][:-1]
+    return ''.join(pieces)
+
 def load_attachment(filename, aka=None, encoding='utf-8'):
     r"""Read and wrap the ``filename`` into a proper MIME message
     """
@@ -77,21 +104,11 @@ def load_attachment(filename, aka=None, encoding='utf-8'):
         message = myMIMEText(fp.read(), subtype, encoding=encoding)
         del message['Content-Disposition']          # no inline for text attachment
         fp.close()
-    elif maintype == 'image':
-        fp = open(filename, 'rb')
-        message = MIMEImage(fp.read(), _subtype=subtype)
-        fp.close()
-    elif maintype == 'audio':
-        fp = open(filename, 'rb')
-        message = MIMEAudio(fp.read(), _subtype=subtype)
-        fp.close()
     else:
-        fp = open(filename, 'rb')
         message = MIMEBase(maintype, subtype)
-        message.set_payload(fp.read())
-        fp.close()
         # Encode the payload using Base64
-        encoders.encode_base64(message)
+        message.set_payload(base64_from_file(filename))
+        message['Content-Transfer-Encoding'] = 'base64'
     if aka:                     # use aka instead of filename, if specified
         filename = aka
     message.add_header('Content-Disposition', 'attachment', filename=filename)
@@ -131,10 +148,69 @@ def header_from_text(text):
     p = HeaderParser()
     return p.parsestr(text, headersonly=True)
 
+def protect(body, mode, gpg, toAddrs, passphraseSYM=None,
+            spool_size=gpgMime.SPOOL_SIZE, **kwds):
+    r"""Let gnupg work on message ``body`` according to ``mode``,
+    and return the resulting message
+    """
+    if mode == 'sign':
+        assert 'passphrase' in kwds, kwds
+        return gpgMime.sign(body, gpg, spool_size=spool_size, **kwds)
+    elif mode == 'encrypt':
+        return gpgMime.encrypt(body, toAddrs, gpg, spool_size=spool_size)
+    elif mode == 'sign-encrypt':
+        assert 'passphrase' in kwds, kwds
+        return gpgMime.sign_and_encrypt(body, toAddrs, gpg,
+                                        spool_size=spool_size, **kwds)
+    elif mode == 'Sencrypt':
+        #
+        # symmetric encryption only, NO signature
+        #   this function is provided for fun and for personal usage
+        try:
+            del kwds['passphrase']
+        except KeyError:
+            pass
+        assert passphraseSYM, kwds
+        kwds['passphrase'] = passphraseSYM
+        kwds['symmetric'] = True
+        del kwds['keyid']
+        return gpgMime.encrypt(body, None, gpg, spool_size=spool_size, **kwds)
+    elif mode == 'sign-Sencrypt':
+        #
+        # sign and symmetric encryption
+        #   this function is provided for fun and for personal usage
+        assert 'passphrase' in kwds, kwds
+        assert passphraseSYM, kwds
+        signedMsg = gpgMime.sign(body, gpg, spool_size=spool_size, **kwds)
+        # preparation for symmetric encryption
+        kwds['symmetric'] = True
+        del kwds['keyid']
+        del kwds['passphrase']
+        kwds['passphrase'] = passphraseSYM
+        return gpgMime.encrypt(signedMsg, None, gpg,
+                               spool_size=spool_size, **kwds)
+    elif mode == 'plain':
+        return body
+    else:
+        raise Exception('unrecognized mode {}'.format(mode))
+
+def peak_rss():
+    r"""Return the peak resident set size (in KB, as on Linux) of this
+    process and of its largest child (gpg)
+    """
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
 if __name__ == '__main__':
-    import gpgMime
     import argparse
 
+    def positive_int(text):
+        value = int(text)
+        if value <= 0:
+            raise argparse.ArgumentTypeError(
+                'positive integer required: {}'.format(text))
+        return value
+
     doc_lines = __doc__.splitlines()
     parser = argparse.ArgumentParser(
         description = doc_lines[0],
@@ -171,6 +247,17 @@ if __name__ == '__main__':
     parser.add_argument(
         '-P', '--passphraseSYM', metavar='PASSPHRASE--Encryption',
         help="passphrase for symmetric encryption")
+    parser.add_argument(
+        '--split', metavar='SIZE', type=positive_int,
+        help='split message into message/partial fragments of SIZE bytes')
+    parser.add_argument(
+        '-j', '--jobs', metavar='N', type=positive_int,
+        help='number of fragments processed in parallel (default: cpu count)')
+    parser.add_argument(
+        '--spool-size', metavar='SIZE', type=positive_int,
+        default=gpgMime.SPOOL_SIZE,
+        help='bytes a buffer flattened for gpg keeps in memory before '
+             'it spills to disk (default: %(default)s)')
     parser.add_argument(
         '--output', action='store_const', const=True,
         help="don't mail the generated message, print it to stdout instead")
@@ -183,6 +270,9 @@ if __name__ == '__main__':
         help='encoding for text files')
 
     args = parser.parse_args()
+    if args.split and args.mode == 'plain':
+        # unprotected fragments are not collected by verify-unpack-mail
+        parser.error('--split requires a sign and/or encrypt mode')
     if args.verbose:
         print args
 
@@ -244,7 +334,7 @@ if __name__ == '__main__':
 
     #
     #   let gnupg work on email body
-    #       --> msgBody
+    #       --> msgBodies
     #
     gpg = gnupg.GPG()
     kwds = {}
@@ -254,75 +344,70 @@ if __name__ == '__main__':
         kwds['keyid'] = args.sign_as
     else:
         kwds['keyid'] = fromAddr
-    if args.mode == 'sign':
-        assert 'passphrase' in kwds, kwds
-        msgBody = gpgMime.sign(body, gpg, **kwds)
-    elif args.mode == 'encrypt':
-        msgBody = gpgMime.encrypt(body, toAddrs, gpg)
-    elif args.mode == 'sign-encrypt':
-        assert 'passphrase' in kwds, kwds
-        msgBody = gpgMime.sign_and_encrypt(body, toAddrs, gpg, **kwds)
-    elif args.mode == 'Sencrypt':
+    if args.split:
         #
-        # symmetric encryption only, NO signature
-        #   this function is provided for fun and for personal usage
-        try:
-            del kwds['passphrase']
-        except KeyError:
-            pass
-        assert args.passphraseSYM, kwds
-        kwds['passphrase'] = args.passphraseSYM
-        kwds['symmetric'] = True
-        del kwds['keyid']
-        msgBody = gpgMime.encrypt(body, None, gpg, **kwds)
-    elif args.mode == 'sign-Sencrypt':
+        # split body into message/partial fragments, and
+        #   let gnupg work on them in parallel
         #
-        # sign and symmetric encryption
-        #   this function is provided for fun and for personal usage
-        assert 'passphrase' in kwds, kwds
-        assert args.passphraseSYM, kwds
-        signedMsg = gpgMime.sign(body, gpg, **kwds)
-        # preparation for symmetric encryption
-        kwds['symmetric'] = True
-        del kwds['keyid']
-        del kwds['passphrase']
-        kwds['passphrase'] = args.passphraseSYM
-        msgBody = gpgMime.encrypt(signedMsg, None, gpg, **kwds)
-    elif args.mode == 'plain':
-        msgBody = body
+        fragments = gpgMime.partial(body, args.split,
+                                    spool_size=args.spool_size)
+        pool = ThreadPool(min(args.jobs or cpu_count(), len(fragments)))
+        msgBodies = pool.map(
+            lambda fragment: protect(fragment, args.mode, gpg, toAddrs,
+                                     args.passphraseSYM, args.spool_size,
+                                     **kwds),
+            fragments)
+        pool.close()
+        pool.join()
     else:
-        raise Exception('unrecognized mode {}'.format(args.mode))
-    #
-    #   combine email headers and body
-    #
-    msg = attach_root(msgHeader, msgBody)
+        msgBodies = [protect(body, args.mode, gpg, toAddrs,
+                             args.passphraseSYM, args.spool_size, **kwds)]
     #
     #   some tricks on subject
     #
     if args.subject:
-        try:                        # delete message subject if exists
-            del msg['Subject']
-        except KeyError:
-            pass
         _subject = args.subject
     else:
-        _subject = msg['Subject']
+        _subject = msgHeader['Subject']
     _subject += ' ' + args.mode
     if args.directory:
         _subject += ' ' + args.directory
     if args.verbose:
         _subject += ' ' + str(os.getpid())
-    msg['Subject'] = _subject
+    #
+    #   combine email headers and body(ies)
+    #
+    msgs = []
+    for n, msgBody in enumerate(msgBodies, 1):
+        msg = attach_root(msgHeader, msgBody)
+        try:                        # delete message subject if exists
+            del msg['Subject']
+        except KeyError:
+            pass
+        if args.split:
+            msg['Subject'] = '%s [%d/%d]' % (_subject, n, len(msgBodies))
+            # fragments with the same Message-ID are dropped as duplicates
+            del msg['Message-ID']
+            msg['Message-ID'] = make_msgid()
+        else:
+            msg['Subject'] = _subject
+        msgs.append(msg)
 
     #
-    #   output or sending the message
+    #   output or sending the message(s)
     #       only smpt on localhost is supported in this version
     #           work for yourself if it does not fit you
     #
     if args.output:
-        print(msg.as_string())
+        # fragments are written as a mailbox (mbox) for verify-unpack-mail
+        for msg in msgs:
+            gpgMime.flatten(msg, sys.stdout, unixfrom=bool(args.split))
+            sys.stdout.write('\n')
     else:
         s = smtplib.SMTP('localhost')
-        s.sendmail(fromAddr, toAddrs, msg.as_string(unixfrom=True))
-        print "%sed message successfully sent to recipient %s" % (args.mode, toAddrs)
-
+        for msg in msgs:
+            s.sendmail(fromAddr, toAddrs, msg.as_string(unixfrom=True))
+        s.quit()
+        print "%sed message successfully sent to recipient %s in %d part(s)" % (
+            args.mode, toAddrs, len(msgs))
+    sys.stderr.write('peak RSS: %d KB (gpg: %d KB)\n' % peak_rss())
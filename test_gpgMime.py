@@ -0,0 +1,98 @@
+# -*- coding: UTF-8 -*-
+"""
+    Tests for gpgMime: flattening for gpg, and message/partial fragments
+
+    run with: python -m unittest test_gpgMime
+"""
+import os, random, unittest, cStringIO
+from email.generator import Generator
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email import encoders
+import gpgMime
+
+def _stock(message):
+    fp = cStringIO.StringIO()
+    Generator(fp, mangle_from_=False).flatten(message)
+    return fp.getvalue()
+
+def _message():
+    inner = MIMEMultipart()
+    inner.preamble = 'From the preamble'
+    inner.epilogue = 'epilogue\n'
+    inner.attach(MIMEText('line\nFrom line\n' * 500))
+    inner.attach(MIMEMultipart())
+    data = MIMEBase('application', 'octet-stream')
+    data.set_payload(os.urandom(100000))
+    encoders.encode_base64(data)
+    data.add_header('Content-Disposition', 'attachment', filename='data.bin')
+    message = MIMEMultipart()
+    message['Subject'] = 'a long subject ' * 10
+    message.attach(MIMEText('hello', 'plain', 'utf-8'))
+    message.attach(inner)
+    message.attach(data)
+    return message
+
+
+class SpoolTest(unittest.TestCase):
+    r"""_spool() must give the stock Generator's output, signatures
+    depend on it
+    """
+    def test_same_as_generator(self):
+        message = _message()
+        spooled = gpgMime._spool(message, spool_size=1024).read()
+        self.assertEqual(spooled, _stock(message))
+
+    def test_crlf(self):
+        message = _message()
+        spooled = gpgMime._spool(message, crlf=True, spool_size=1024).read()
+        self.assertEqual(spooled, _stock(message).replace('\n', '\r\n'))
+
+    def test_multipart_signed(self):
+        signed = MIMEMultipart(
+            'signed', micalg='pgp-sha1', protocol='application/pgp-signature')
+        signed.attach(_message())
+        signed.attach(MIMEText('signature'))
+        self.assertEqual(gpgMime._spool(signed).read(), _stock(signed))
+
+    def test_flatten(self):
+        message = _message()
+        fp = cStringIO.StringIO()
+        gpgMime.flatten(message, fp)
+        self.assertEqual(fp.getvalue(), _stock(message))
+
+
+class PartialTest(unittest.TestCase):
+    def test_round_trip(self):
+        message = _message()
+        fragments = gpgMime.partial(message, 10000, spool_size=1024)
+        self.assertTrue(len(fragments) > 1)
+        received = [gpgMime.message_from_string(f.as_string())
+                    for f in fragments]
+        self.assertEqual(''.join(f.get_payload() for f in received),
+                         _stock(message))
+        random.shuffle(received)
+        received.append(received[0])            # a resent fragment
+        original = gpgMime.message_from_string(_stock(message))
+        self.assertEqual(_stock(gpgMime.reassemble(received)),
+                         _stock(original))
+
+    def test_fragment_kept_as_string(self):
+        fragment = gpgMime.partial(_message(), 10000)[1]
+        received = gpgMime.message_from_string(fragment.as_string())
+        self.assertEqual(_stock(received), _stock(fragment))
+
+    def test_missing_fragment(self):
+        fragments = gpgMime.partial(_message(), 10000)
+        self.assertRaises(ValueError, gpgMime.reassemble, fragments[1:])
+
+    def test_different_total(self):
+        message = _message()
+        fragments = gpgMime.partial(message, 10000, id='<id@test>')
+        others = gpgMime.partial(message, 50000, id='<id@test>')
+        self.assertRaises(ValueError, gpgMime.reassemble,
+                          fragments[:1] + others[1:])
+
+if __name__ == '__main__':
+    unittest.main()
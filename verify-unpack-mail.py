@@ -2,20 +2,22 @@
 """
     Using gpgMime to verify/decrypt PGP/MIME messages, and
         unpack messages if all things go right.
+    message/partial fragments are reassembled before unpacking.
 
     Jay S. Liu
     jay.s.liu@gmail.com
     Mar. 24, 2013
     Version: 0.1
 """
-import sys, os, email, os.path
-import mimetypes
+import sys, os, os.path
+import mimetypes, mailbox
 import gnupg
 import gpgMime
 
-def work(message, gpg, directory=None, _fileOut=True, **kwargs):
-    r"""verify/decrypt the mime ``message``; unpack it
-    into the specified ``directory`` if successful
+def verify_message(message, gpg, **kwargs):
+    r"""verify/decrypt the mime ``message``; return the verified content
+    and the fingerprint of its signing key (None if not signed), or
+    (None, None) if ``message`` is not a PGP/MIME message
     """
     ct = message.get_content_type()
     if ct == 'multipart/encrypted':
@@ -24,13 +26,69 @@ def work(message, gpg, directory=None, _fileOut=True, **kwargs):
         if ct == 'multipart/signed':
             message, verified = gpgMime.verify(message, gpg, **kwargs)
             print 'Message signed by %s is verified OK.' % verified.username
-        unpackMime(message, directory, _fileOut)
+            return (message, verified.fingerprint)
+        return (message, None)
     elif ct == 'multipart/signed':
         message, verified = gpgMime.verify(message, gpg, **kwargs)
         print 'Message signed by %s is verified OK.' % verified.username
-        unpackMime(message, directory, _fileOut)
+        return (message, verified.fingerprint)
     else:
         sys.stderr.write('!!! Wrong message type !!!\n')
+        return (None, None)
+
+def iter_messages(filenames, mbox=False):
+    r"""yield the messages in files ``filenames`` one at a time,
+    each file being a mailbox in mbox format if ``mbox``
+    """
+    for filename in filenames:
+        if mbox:
+            box = mailbox.mbox(filename, factory=gpgMime.message_from_file,
+                               create=False)
+            for message in box:
+                yield message
+            box.close()
+        else:
+            fp = open(filename, 'U')
+            message = gpgMime.message_from_file(fp)
+            fp.close()
+            yield message
+
+def work_all(messages, gpg, directory=None, _fileOut=True, **kwargs):
+    r"""verify/decrypt all mime ``messages``; unpack each of them
+    into the specified ``directory`` if successful
+
+    message/partial fragments are collected by their id, and the original
+    message is reassembled and unpacked once all its fragments are verified
+    and signed by the same key
+    """
+    fragments = {}
+    signers = {}
+    for message in messages:
+        try:
+            message, signer = verify_message(message, gpg, **kwargs)
+        except (AssertionError, ValueError) as e:
+            sys.stderr.write('!!! Verification failed: %s !!!\n' % (e,))
+            continue
+        if message is None:
+            continue
+        if message.get_content_type() == 'message/partial':
+            id = message.get_param('id')
+            fragments.setdefault(id, []).append(message)
+            signers.setdefault(id, set()).add(signer)
+            continue
+        unpackMime(message, directory, _fileOut)
+    for id, parts in fragments.items():
+        if len(signers[id]) > 1:
+            sys.stderr.write('!!! Fragments of message %s signed by different '
+                             'keys: %s !!!\n' % (id, sorted(signers[id])))
+            continue
+        try:
+            message = gpgMime.reassemble(parts)
+        except ValueError as e:
+            sys.stderr.write('!!! Incomplete message %s: %s !!!\n' % (id, e))
+            continue
+        print 'Message %s reassembled from %d fragment messages.' % (id, len(parts))
+        unpackMime(message, directory, _fileOut)
 
 def unpackMime(message, directory='tmp', _fileOut=True):
     r"""unpack the mime ``message`` into the specified ``directory``
@@ -68,8 +126,11 @@ def main():
     parser = argparse.ArgumentParser()
 
     parser.add_argument(
-        '-f', '--message-file', metavar='FILE', required=True,
-        help='the mime message file to be verified')
+        '-f', '--message-file', metavar='FILE', nargs='+', required=True,
+        help='the mime message file(s) to be verified')
+    parser.add_argument(
+        '--mbox', action='store_const', const=True,
+        help='message file(s) are mailboxes in mbox format')
     parser.add_argument(
         '-d', '--directory', metavar='DIRECTORY',
         help='directory name to store unpacked files')
@@ -82,10 +143,6 @@ def main():
 
     args = parser.parse_args()
 
-    fp = open(args.message_file, 'U')
-    msg = email.message_from_file(fp)
-    fp.close()
-
     if args.output:
         _fileOut = False
     else:
@@ -102,7 +159,8 @@ def main():
     if not os.path.exists(targetDir):
         os.mkdir(targetDir)
 
-    work(msg, gpg, targetDir, _fileOut, **kwds)
+    msgs = iter_messages(args.message_file, args.mbox)
+    work_all(msgs, gpg, targetDir, _fileOut, **kwds)
 
 if __name__ == '__main__':
     main()